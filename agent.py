@@ -1,129 +1,492 @@
 # agent.py - 修正版 3: 增加重试机制以应对 API 504 等临时错误
 
+import asyncio
+import collections
+import concurrent.futures
 import json
+import logging
 import os
+import re
+import shlex
+import signal
 import subprocess
 import sys
+import time
 import requests
-import time # 引入 time 模块用于重试时的等待
+from functools import lru_cache
 from pathlib import Path
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
+try:
+    import orjson # C 实现的 JSON 库，用于序列化请求体和历史消息
+except ImportError: # 未安装 orjson 时退回标准库 json
+    orjson = None
 
-class ECNUChatAgent:
-    def __init__(self, api_key):
-        self.api_key = api_key
-        self.base_url = "https://chat.ecnu.edu.cn/open/api/v1"
-        self.session_history = [] # 维护对话历史
-        self.max_context_length = 30000 # 设置一个安全的上下文长度限制，单位为token数的近似估计字符数
-        # 修改点: 将 JSON 格式中的 { 和 } 进行转义 ({{ 和 }})
-        self.system_prompt = """你是一个强大的AI助手，被设计为一个可以在Linux命令行环境中执行任务的智能代理。你的目标是理解和执行用户的指令，通过执行系统命令、读写文件等方式来完成任务。
+try:
+    import aiofiles # 用于 read_files 动作中并发读取多个文件
+except ImportError: # 未安装 aiofiles 时在线程池中执行阻塞读取
+    aiofiles = None
+
+try:
+    import tiktoken # 用于精确计算 token 数
+except ImportError: # 未安装 tiktoken 时退化为按字符数估算
+    tiktoken = None
+
+
+# 系统提示词中的静态规则部分；不会对其调用 str.format，因此 JSON 示例中的花括号无需转义
+_SYSTEM_PREFIX = """你是一个强大的AI助手，被设计为一个可以在Linux命令行环境中执行任务的智能代理。你的目标是理解和执行用户的指令，通过执行系统命令、读写文件等方式来完成任务。
 
 重要规则：
 1.  你必须严格遵循以下JSON格式来输出你的计划和行动，不允许有任何其他文字或解释。如果需要向用户输出信息，则使用 "action": "speak"。
-    {{"action": "command", "command": "要执行的具体命令", "explanation": "为什么要执行此命令"}}
-    {{"action": "read_file", "path": "/path/to/file", "explanation": "为什么要读取此文件"}}
-    {{"action": "write_file", "path": "/path/to/file", "content": "文件的新内容", "explanation": "为什么要写入此文件"}}
-    {{"action": "speak", "message": "你想对用户说的话", "explanation": "为什么需要说这句话"}}
+    {"action": "command", "command": "要执行的具体命令", "explanation": "为什么要执行此命令"}
+    {"action": "read_file", "path": "/path/to/file", "explanation": "为什么要读取此文件"}
+    {"action": "read_files", "paths": ["/path/to/file1", "/path/to/file2"], "explanation": "为什么要一次读取这些文件"}
+    {"action": "write_file", "path": "/path/to/file", "content": "文件的新内容", "explanation": "为什么要写入此文件"}
+    {"action": "show_output", "id": "out_1", "offset": 0, "length": 4096, "explanation": "为什么需要查看被省略的输出"}
+    {"action": "speak", "message": "你想对用户说的话", "explanation": "为什么需要说这句话"}
+    需要读取多个文件时，优先使用 read_files 一次读取。
+    命令输出过长时只会返回开头和结尾，中间部分会被省略并给出一个 id，需要时可用 show_output 按 offset/length 查看完整输出的指定片段。
 2.  你拥有sudo权限，如果需要，可以直接在命令前加 'sudo'。
 3.  在执行任何写入文件或修改系统的关键操作前，务必先读取文件内容，确认后再写入。
 4.  每次只输出一个JSON对象。执行完该动作并收到结果后，再进行下一步。
-5.  你的回答应该简洁明了，专注于任务本身。
-6.  你当前的工作目录是: {working_dir}
-7.  今天是: {current_date}"""
-
-    def _truncate_history(self):
-        """简单地按字符数截断历史记录以控制上下文长度"""
-        total_chars = len(self.system_prompt)
-        truncated_history = []
-        # 逆序遍历，保留最新的消息
-        for item in reversed(self.session_history):
-            item_chars = len(json.dumps(item))
-            if total_chars + item_chars > self.max_context_length:
-                break
-            truncated_history.insert(0, item)
-            total_chars += item_chars
-        self.session_history = truncated_history
-
-    def _call_model(self, prompt, max_retries=3, backoff_factor=1): # 添加重试参数
-        """调用ChatECNU API，包含重试逻辑"""
-        headers = {
-            "Authorization": f"Bearer {self.api_key}",
-            "Content-Type": "application/json",
-        }
+5.  你的回答应该简洁明了，专注于任务本身。"""
+
+
+# 调试/诊断信息走 logging，用 %s 惰性格式化，级别关闭时不会对大对象做字符串化
+# 通过环境变量 ECNU_LOG 设置级别，例如 export ECNU_LOG=DEBUG
+logger = logging.getLogger("ecnu")
+if not logger.handlers: # 避免重复导入时重复添加 handler
+    _log_handler = logging.StreamHandler()
+    _log_handler.setFormatter(logging.Formatter("[%(levelname)s] %(message)s"))
+    logger.addHandler(_log_handler)
+_log_level = (os.getenv("ECNU_LOG") or "INFO").upper()
+if isinstance(logging.getLevelName(_log_level), int):
+    logger.setLevel(_log_level)
+else: # 非法的级别名不应导致 agent 无法启动
+    logger.setLevel(logging.INFO)
+    logger.warning("Invalid ECNU_LOG level %r, falling back to INFO.", _log_level)
+
+
+def _dumps(obj):
+    """将对象序列化为紧凑的 UTF-8 JSON 字节串，优先使用 orjson"""
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj)
+        except orjson.JSONEncodeError: # 如超出 64 位范围的整数，交给标准库处理
+            pass
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode("utf-8")
+
+
+def _loads(data):
+    """解析 JSON 字符串或字节串，优先使用 orjson"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def _encode_chat_body(options, message_bytes):
+    """拼接补全请求体：options 为除 messages 外的字段，message_bytes 为已序列化好的各条消息
+
+    结果与 _dumps({**options, "messages": [...]}) 完全一致，但每轮只需序列化新增的部分。
+    """
+    return _dumps(options)[:-1] + b',"messages":[' + b",".join(message_bytes) + b"]}"
 
+
+# 命令中出现这些字符时，说明依赖管道、重定向、通配符、变量展开等 shell 特性
+_SHELL_METACHARS = frozenset("|&;<>*?$`()~{}[]#\n")
+# 只存在于 shell 内部、无法直接 exec 的内建命令
+_SHELL_BUILTINS = frozenset(["cd", "export", "source", ".", "alias", "unalias", "set", "unset", "ulimit", "umask", "eval", "exec", "pushd", "popd", "type"])
+
+
+def _needs_shell(cmd):
+    """判断命令是否必须交给 /bin/sh 执行"""
+    if any(c in _SHELL_METACHARS for c in cmd):
+        return True
+    first = cmd.split(None, 1)[0] if cmd.strip() else ""
+    # sudo 可能依赖 shell 的 PATH/PTY 语义；VAR=value 形式的环境变量前缀也需要 shell
+    return first == "sudo" or first in _SHELL_BUILTINS or "=" in first
+
+
+# 命令中包含这些会改变目录结构的程序时，清空路径解析缓存
+_FS_LAYOUT_CMD_RE = re.compile(r"\b(?:mv|rm|rmdir|ln|mkdir)\b")
+
+_OUTPUT_ELIDE_THRESHOLD = 4096 # 命令输出超过该长度时只保留首尾，其余部分存入 _output_store
+_OUTPUT_KEEP = 2048 # 首尾各保留的字符数
+_OUTPUT_STORE_SIZE = 32 # 最多保留多少份完整输出，超出后按 LRU 淘汰
+
+_MAX_READ_BYTES = 512 * 1024 # read_file 最多读取的字节数，超出部分截断，避免撑爆内存和上下文
+_MAX_BATCH_FILES = 16 # read_files 单次最多读取的文件数
+_READ_CONCURRENCY = 8 # read_files 同时打开的文件数上限，避免 EMFILE 和内存峰值
+
+
+def _decode_file_content(data, file_size):
+    """将读取到的字节解码为文本；二进制文件只返回简短描述，超长文件截断并注明省略的字节数"""
+    if b"\0" in data[:512]: # 前 512 字节中出现 NUL，视为二进制文件
+        return f"[binary file, {file_size} bytes, content not shown]"
+    if len(data) > _MAX_READ_BYTES:
+        return data[:_MAX_READ_BYTES].decode("utf-8", errors="replace") + f"\n...[truncated {file_size - _MAX_READ_BYTES} bytes]"
+    return data.decode("utf-8", errors="replace")
+
+
+_CODE_FENCE_RE = re.compile(r"^```(?:json)?\s*|\s*```$", flags=re.S) # 模型常用的 ```json ... ``` 代码块标记
+_JSON_DECODER = json.JSONDecoder()
+
+
+def _extract_action_json(text):
+    """从模型输出中提取第一个 JSON 对象，容忍代码块标记以及前后多余的文字
+
+    依次尝试每个 { 的位置，返回第一个能解码出字典的结果；都失败时抛出最后一次的 json.JSONDecodeError。
+    """
+    text = _CODE_FENCE_RE.sub("", text.strip()).lstrip()
+    start = text.find("{")
+    if start == -1:
+        return _JSON_DECODER.raw_decode(text)[0] # 没有对象时照常报错
+    error = None
+    while start != -1:
+        try:
+            obj, _end = _JSON_DECODER.raw_decode(text, start)
+            if isinstance(obj, dict):
+                return obj
+        except json.JSONDecodeError as e:
+            error = e
+        start = text.find("{", start + 1)
+    raise error
+
+
+class ECNUChatAgent:
+    # 服务端是否支持 response_format=json_object；首次被拒绝后在整个进程内不再发送该字段
+    _supports_json_mode = True
+
+    def __init__(self, api_key):
+        self.api_key = api_key
+        self.base_url = "https://chat.ecnu.edu.cn/open/api/v1"
+        # 复用同一个 Session，保持与 API 的长连接，避免每轮重新进行 TCP/TLS 握手
+        self.session = requests.Session()
+        self.session.headers.update({
+            "Authorization": f"Bearer {api_key}",
+            "Content-Type": "application/json",
+        })
+        # 由 urllib3 在传输层对 5xx 做指数退避重试，并自动遵循 Retry-After 头
+        retry = Retry(
+            total=3,
+            backoff_factor=1,
+            status_forcelist=(500, 502, 503, 504),
+            allowed_methods=frozenset(["POST"]),
+            raise_on_status=False, # 重试用尽后返回最后一次响应，交由 raise_for_status 处理
+        )
+        self.session.mount("https://", HTTPAdapter(max_retries=retry, pool_connections=4, pool_maxsize=8))
+        # 后台线程: 在子进程运行期间预热到 API 的连接，把 TCP/TLS 建连藏在等待时间里
+        self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+        # 被省略的完整命令输出，按 id 存放，供 show_output 动作查看
+        self._output_store = collections.OrderedDict()
+        self._output_seq = 0
+        # 熔断器: 连续多次 5xx/超时/连接失败后暂停调用 API，冷却后放行一次探测请求
+        self._cb_state = "closed" # closed / open / half-open
+        self._cb_fail_count = 0
+        self._cb_opened_at = 0
+        self._cb_threshold = 5 # 连续失败多少次后熔断
+        self._cb_cooldown = 30 # 熔断后的冷却时间（秒）
+        self.session_history = collections.deque() # 维护对话历史，超出 token 预算时从左侧丢弃最旧的消息
+        self.max_context_tokens = 16000 # 系统提示词 + 历史记录的 token 预算
+        self.max_context_chars = 30000 # 无法使用 tiktoken 时改按字符数计算的预算
+        self._enc = None
+        if tiktoken is not None:
+            try:
+                self._enc = tiktoken.get_encoding("cl100k_base")
+            except Exception as e: # 首次使用需要下载编码文件，无网络时退化为按字符数估算
+                logger.warning("Failed to load tiktoken encoding, falling back to character counts: %s", e)
+        # _count_tokens 的计量单位随 _enc 而定，预算也要使用同一单位
+        self._context_budget = self.max_context_tokens if self._enc is not None else self.max_context_chars
+        self._history_tokens = 0 # 历史记录中所有消息的 token 总数，随追加/丢弃增量维护
+        # 超出预算时不直接丢弃旧消息，而是将其压缩为一条摘要固定在历史最前面
+        self._summary_max_tokens = 300 # 摘要的最大 token 数
+        self._summary_depth = 0 # 当前摘要已嵌套（摘要的摘要）的层数
+        self._max_summary_depth = 3 # 超过该层数后直接丢弃旧摘要，避免信息被反复稀释
+        self.current_date = "2025-12-10"
+        # 缓存拼接好的系统消息，仅在工作目录变化时重新生成
+        self._cwd = os.getcwd()
+        self._refresh_system_msg()
+
+    def _refresh_system_msg(self):
+        """根据当前工作目录和日期拼接系统提示词，并缓存系统消息及其 token 数"""
+        self.system_prompt = f"{_SYSTEM_PREFIX}\n6.  你当前的工作目录是: {self._cwd}\n7.  今天是: {self.current_date}"
+        self._system_msg = self._prepare_message({"role": "system", "content": self.system_prompt})
+        self._system_tokens = self._system_msg["_tokens"]
+
+    def _prepare_message(self, msg):
+        """为消息缓存 token 数（_tokens）和序列化后的字节串（_bytes），之后发送和裁剪历史时都不再重新计算"""
+        msg["_tokens"] = self._count_tokens(msg["content"])
+        msg["_bytes"] = _dumps({"role": msg["role"], "content": msg["content"]})
+        return msg
+
+    def _count_tokens(self, text):
+        """计算文本的 token 数；tiktoken 不可用时返回字符数（此时预算为 max_context_chars）"""
+        if self._enc is None:
+            return len(text)
+        return len(self._enc.encode(text))
+
+    def _clip_content(self, content, max_tokens):
+        """单条消息本身就超出预算时，只保留首尾使其不超过 max_tokens，完整内容存入 _output_store"""
+        tokens = self._count_tokens(content)
+        if tokens <= max_tokens:
+            return content
+        output_id = self._store_output(content)
+        ratio = max_tokens / tokens
+        while tokens > max_tokens:
+            keep = int(len(content) * ratio / 2) # 首尾各保留的字符数，每轮按比例收缩直到符合预算
+            clipped = f"{content[:keep]}\n...[{len(content) - 2 * keep} chars clipped to fit the context budget, id={output_id}]...\n{content[len(content) - keep:]}"
+            tokens = self._count_tokens(clipped)
+            ratio *= 0.8
+        return clipped
+
+    def _append_history(self, msg):
+        """追加一条消息到历史；超出 token 预算时把最旧的消息压缩为摘要"""
+        # 最新的消息在裁剪时总会被保留，因此它自身必须能放进裁剪后的预算，否则请求仍会超出预算
+        limit = self._context_budget // 2 - self._summary_max_tokens - self._system_tokens
+        msg["content"] = self._clip_content(msg["content"], limit)
+        self.session_history.append(self._prepare_message(msg))
+        self._history_tokens += msg["_tokens"]
+        if self._system_tokens + self._history_tokens <= self._context_budget:
+            return
+
+        # 一次腾出约一半的预算（并为摘要预留空间），避免之后每追加一条消息都要调用一次摘要
+        target = self._context_budget // 2 - self._summary_max_tokens
+        dropped = []
+        # 至少保留最新的一条消息
+        while self._system_tokens + self._history_tokens > target and len(self.session_history) > 1:
+            old = self.session_history.popleft()
+            self._history_tokens -= old["_tokens"]
+            if old.get("_summary") and self._summary_depth >= self._max_summary_depth:
+                self._summary_depth = 0 # 嵌套层数已达上限，丢弃旧摘要
+                continue
+            dropped.append(old)
+
+        summary = self._summarize_prefix(dropped) if dropped else None
+        if summary:
+            self._summary_depth += 1
+            summary_msg = self._prepare_message({"role": "system", "content": f"Prior context summary: {summary}", "_summary": True})
+            self.session_history.appendleft(summary_msg)
+            self._history_tokens += summary_msg["_tokens"]
+        elif any(m.get("_summary") for m in dropped):
+            self._summary_depth = 0 # 摘要失败时旧摘要也已被丢弃
+
+    def _summarize_prefix(self, msgs):
+        """用一次独立的非流式请求把被挤出窗口的消息压缩为摘要；失败时返回 None，退化为直接截断"""
+        if self._cb_state == "open":
+            return None
+        # 单条消息只取前 2000 个字符，防止超长的命令输出或文件内容撑爆摘要请求
+        transcript = "\n".join(f"{m['role']}: {m['content'][:2000]}" for m in msgs)
         payload = {
-            "model": "ecnu-plus", # 修改点: 使用官方推荐的 ecnu-plus 模型
+            "model": "ecnu-plus",
             "messages": [
-                {"role": "system", "content": self.system_prompt.format(working_dir=os.getcwd(), current_date="2025-12-10")}, # 注入当前工作目录和日期
-            ] + self.session_history + [{"role": "user", "content": prompt}],
+                {"role": "system", "content": f"Summarize the following tool/dialog turns in <= {self._summary_max_tokens} tokens, keeping decisions, file paths, and errors."},
+                {"role": "user", "content": transcript},
+            ],
+            "temperature": 0.2,
+            "max_tokens": self._summary_max_tokens,
+        }
+        try:
+            logger.debug("Summarizing %d history messages...", len(msgs))
+            response = self.session.post(f"{self.base_url}/chat/completions", data=_dumps(payload), timeout=(5, 60))
+            response.raise_for_status()
+            return _loads(response.content)["choices"][0]["message"]["content"].strip()
+        except Exception as e:
+            logger.warning("Failed to summarize history, dropping %d messages instead: %s", len(msgs), e)
+            return None
+
+    @staticmethod
+    @lru_cache(maxsize=256)
+    def _resolve(p):
+        """缓存路径解析结果，先读后写同一文件时不必重复 lstat 整条路径
+
+        该缓存在整个进程内共享（并非每个 agent 实例各自一份），以原始路径字符串为键。
+        """
+        return Path(p).resolve()
+
+    async def _read_one(self, path_str):
+        """读取单个文件，与 read_file 使用相同的大小上限和解码方式；出错时返回错误描述"""
+        file_path = self._resolve(path_str)
+        try:
+            if not file_path.is_file():
+                return f"File does not exist or is not a regular file: {file_path}"
+            st = file_path.stat()
+            if aiofiles is not None:
+                async with aiofiles.open(file_path, 'rb') as f:
+                    data = await f.read(_MAX_READ_BYTES + 1)
+            else:
+                def _read():
+                    with open(file_path, 'rb') as f:
+                        return f.read(_MAX_READ_BYTES + 1)
+                data = await asyncio.to_thread(_read)
+            return _decode_file_content(data, st.st_size)
+        except PermissionError:
+            return f"Permission denied when reading file: {file_path}"
+        except Exception as e:
+            return f"An error occurred while reading file '{file_path}': {str(e)}"
+
+    async def _read_many(self, paths):
+        """并发读取多个文件（同时打开的文件数不超过 _READ_CONCURRENCY），返回 {path: 内容或错误信息}"""
+        semaphore = asyncio.Semaphore(_READ_CONCURRENCY)
+
+        async def _bounded(p):
+            async with semaphore:
+                return await self._read_one(p)
+
+        contents = await asyncio.gather(*(_bounded(p) for p in paths))
+        return dict(zip(paths, contents))
+
+    def _store_output(self, text):
+        """把完整内容存入 _output_store（超出容量时按 LRU 淘汰），返回供 show_output 使用的 id"""
+        self._output_seq += 1
+        output_id = f"out_{self._output_seq}"
+        self._output_store[output_id] = text
+        while len(self._output_store) > _OUTPUT_STORE_SIZE:
+            self._output_store.popitem(last=False)
+        return output_id
+
+    def _elide_output(self, text):
+        """过长的输出只保留首尾写入历史，完整内容存入 _output_store 并在省略处注明 id"""
+        if len(text) <= _OUTPUT_ELIDE_THRESHOLD:
+            return text
+        output_id = self._store_output(text)
+        elided = len(text) - 2 * _OUTPUT_KEEP
+        return f"{text[:_OUTPUT_KEEP]}\n...[{elided} chars elided, id={output_id}]...\n{text[-_OUTPUT_KEEP:]}"
+
+    def _warm_connection(self):
+        """在后台发送一个轻量 HEAD 请求，保持连接池中的连接处于可用状态"""
+        if self._cb_state == "open": # 熔断期间不打扰服务端
+            return
+        # 结果和异常都不关心，预热失败不影响后续的正式请求
+        self._pool.submit(self.session.head, self.base_url, timeout=2)
+
+    def _cb_record_success(self):
+        """API 可用，关闭熔断器并清零失败计数"""
+        self._cb_state = "closed"
+        self._cb_fail_count = 0
+
+    def _cb_record_failure(self):
+        """记录一次 API 故障，达到阈值或半开探测失败时打开熔断器"""
+        self._cb_fail_count += 1
+        if self._cb_state == "half-open" or self._cb_fail_count >= self._cb_threshold:
+            self._cb_state = "open"
+            self._cb_opened_at = time.time()
+            logger.warning("Circuit breaker opened after %d consecutive failures. Pausing API calls for %d seconds.", self._cb_fail_count, self._cb_cooldown)
+
+    @staticmethod
+    def _is_upstream_failure(e):
+        """只有 5xx、连接错误和超时才计入熔断失败次数，4xx 或解析错误不算"""
+        if isinstance(e, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+            return True
+        response = getattr(e, "response", None)
+        return response is not None and 500 <= response.status_code < 600
+
+    @staticmethod
+    def _read_event_stream(response):
+        """逐行读取 SSE 流，拼接每个分片中 choices[0].delta.content 的内容"""
+        parts = []
+        done = False
+        # 按字节读取并只在 \n 处分行：解码后的 str.splitlines() 还会在 U+2028/U+2029/U+0085 处断行，
+        # 而服务端以 ensure_ascii=False 输出的 JSON 字符串里可能直接包含这些字符
+        for line in response.iter_lines(delimiter=b"\n"):
+            # 收到 [DONE] 后继续读到 EOF 而不是 break，响应体读完后连接才能放回连接池复用
+            if done or not line.startswith(b"data:"):
+                continue
+            data = line[len(b"data:"):].strip()
+            if data == b"[DONE]":
+                done = True
+                continue
+            chunk = _loads(data)
+            if chunk.get("choices"):
+                parts.append(chunk["choices"][0].get("delta", {}).get("content") or "")
+        return "".join(parts)
+
+    def _post_completions(self, options, message_bytes):
+        """发送流式补全请求；若服务端以 400 拒绝 response_format，则去掉该字段重试一次"""
+        url = f"{self.base_url}/chat/completions"
+        # 请求体自行拼接，Content-Type 已在 Session 的默认请求头中设置
+        response = self.session.post(url, data=_encode_chat_body(options, message_bytes), timeout=(5, 60), stream=True) # (连接超时, 读取超时)
+        if response.status_code == 400 and "response_format" in options and "response_format" in response.text:
+            logger.warning("API does not support response_format=json_object, retrying without it.")
+            response.close()
+            ECNUChatAgent._supports_json_mode = False
+            del options["response_format"]
+            response = self.session.post(url, data=_encode_chat_body(options, message_bytes), timeout=(5, 60), stream=True)
+        return response
+
+    def _call_model(self, prompt=None):
+        """调用ChatECNU API，5xx 重试由 Session 上挂载的 Retry 负责
+
+        prompt 为 None 时不再追加额外的 user 消息，直接以历史中最后一条 user 消息作为输入。
+        """
+        if self._cb_state == "open":
+            if time.time() - self._cb_opened_at < self._cb_cooldown:
+                error_msg = "API is temporarily unavailable (circuit breaker open). Please try again later."
+                logger.error("%s", error_msg)
+                return {"action": "speak", "message": error_msg, "explanation": "API熔断中"}
+            self._cb_state = "half-open" # 冷却结束，放行一次探测请求
+            logger.info("Circuit breaker half-open, probing API...")
+
+        cwd = os.getcwd()
+        if cwd != self._cwd: # 工作目录变化时刷新缓存的系统消息
+            self._cwd = cwd
+            self._refresh_system_msg()
+            self._resolve.cache_clear() # 相对路径的解析结果依赖工作目录
+
+        options = {
+            "model": "ecnu-plus", # 修改点: 使用官方推荐的 ecnu-plus 模型
             "temperature": 0.2, # 较低的温度使输出更确定、一致
+            "stream": True, # 以 SSE 流式返回，边生成边接收
         }
+        if self._supports_json_mode:
+            options["response_format"] = {"type": "json_object"} # 要求服务端保证输出为合法 JSON
+        # 直接复用各条消息缓存的序列化结果，只有新的 prompt 需要现场编码
+        message_bytes = [self._system_msg["_bytes"], *(m["_bytes"] for m in self.session_history)]
+        if prompt is not None:
+            message_bytes.append(_dumps({"role": "user", "content": prompt}))
+
+        try:
+            logger.debug("Sending request to API...")
+            with self._post_completions(options, message_bytes) as response:
+                response.raise_for_status() # 重试用尽后仍失败的请求在此抛出异常
+                self._cb_record_success()
+
+                if response.headers.get("Content-Type", "").startswith("text/event-stream"):
+                    content = self._read_event_stream(response)
+                else:
+                    # 服务端未按流式返回时，退回到一次性解析完整响应
+                    response_data = _loads(response.content)
+                    logger.debug("API Response: %s", response_data) # 记录原始响应，用于调试
 
-        for attempt in range(max_retries):
-            try:
-                print(f"[DEBUG] Sending request to API (Attempt {attempt + 1}/{max_retries})...") # 调试信息，显示尝试次数
-                response = requests.post(f"{self.base_url}/chat/completions", headers=headers, json=payload)
-                
-                # 检查是否是 504 错误或类似的上游错误
-                if response.status_code == 504 or (response.status_code >= 500 and response.status_code < 600):
-                    print(f"[WARNING] API returned status {response.status_code}. This might be a temporary issue. Attempt {attempt + 1}/{max_retries}.")
-                    if attempt < max_retries - 1: # 如果不是最后一次尝试
-                        sleep_time = backoff_factor * (2 ** attempt) # 指数退避
-                        print(f"[INFO] Waiting {sleep_time} seconds before retrying...")
-                        time.sleep(sleep_time)
-                        continue # 继续下一次尝试
-                    else:
-                        # 所有重试都失败了
-                        print(f"[ERROR] All {max_retries} attempts failed with status {response.status_code}.")
-                        response.raise_for_status() # 抛出异常
-                
-                response.raise_for_status() # 对于非 5xx 错误，直接抛出异常
-                response_data = response.json()
-
-                print(f"[DEBUG] API Response: {response_data}") # 打印原始响应，用于调试
-
-                if 'choices' in response_data and len(response_data['choices']) > 0:
+                    if 'choices' not in response_data or len(response_data['choices']) == 0:
+                        logger.error("Unexpected API response format: %s", response_data)
+                        return {"action": "speak", "message": "API返回了意外的格式。", "explanation": "API响应错误"}
                     content = response_data['choices'][0]['message']['content']
-                    print(f"[DEBUG] Model Content: {content}") # 打印模型返回的内容
 
-                    # 尝试解析模型返回的JSON
-                    try:
-                        action_json = json.loads(content.strip())
-                        print(f"[DEBUG] Parsed Action: {action_json}") # 打印解析后的动作
-                        return action_json
-                    except json.JSONDecodeError as e:
-                        print(f"[ERROR] Model response is not valid JSON:\n{content}\nError: {e}")
-                        # 如果不是JSON，强制模型返回一个 speak 动作
-                        return {"action": "speak", "message": f"模型返回了非预期格式: {content}", "explanation": "解析模型输出失败"}
-                else:
-                    print(f"[ERROR] Unexpected API response format: {response_data}")
-                    return {"action": "speak", "message": "API返回了意外的格式。", "explanation": "API响应错误"}
-
-            except requests.exceptions.RequestException as e:
-                # 检查是否是 504 或其他上游错误导致的 RequestException
-                if hasattr(e, 'response') and e.response is not None:
-                    if e.response.status_code == 504 or (e.response.status_code >= 500 and e.response.status_code < 600):
-                         print(f"[WARNING] RequestException with upstream error (status {e.response.status_code}). Attempt {attempt + 1}/{max_retries}.")
-                         if attempt < max_retries - 1:
-                            sleep_time = backoff_factor * (2 ** attempt)
-                            print(f"[INFO] Waiting {sleep_time} seconds before retrying...")
-                            time.sleep(sleep_time)
-                            continue
-                         else:
-                            print(f"[ERROR] All {max_retries} attempts failed due to upstream error (status {e.response.status_code}).")
-                
-                error_msg = f"API call failed: {str(e)}"
-                print(f"[ERROR] {error_msg}")
-                return {"action": "speak", "message": error_msg, "explanation": "API调用失败"}
-            except Exception as e:
-                error_msg = f"An unexpected error occurred during API call: {str(e)}"
-                print(f"[ERROR] {error_msg}")
-                return {"action": "speak", "message": error_msg, "explanation": "发生未知错误"}
+            logger.debug("Model Content: %s", content) # 记录模型返回的内容
 
-        # 如果循环结束仍未成功（理论上不应该到达这里，因为上面会返回），则返回错误
-        error_msg = f"Failed to get a valid response from the API after {max_retries} attempts."
-        print(f"[ERROR] {error_msg}")
-        return {"action": "speak", "message": error_msg, "explanation": "API多次调用失败"}
+            # 尝试解析模型返回的JSON
+            try:
+                action_json = _extract_action_json(content)
+                logger.debug("Parsed Action: %s", action_json) # 记录解析后的动作
+                return action_json
+            except json.JSONDecodeError as e:
+                logger.error("Model response is not valid JSON:\n%s\nError: %s", content, e)
+                # 如果不是JSON，强制模型返回一个 speak 动作
+                return {"action": "speak", "message": f"模型返回了非预期格式: {content}", "explanation": "解析模型输出失败"}
+
+        except requests.exceptions.RequestException as e:
+            if self._is_upstream_failure(e):
+                self._cb_record_failure()
+            elif self._cb_state == "half-open": # 服务端有响应（如 4xx），说明已恢复
+                self._cb_record_success()
+            error_msg = f"API call failed: {str(e)}"
+            logger.error("%s", error_msg)
+            return {"action": "speak", "message": error_msg, "explanation": "API调用失败"}
+        except Exception as e:
+            error_msg = f"An unexpected error occurred during API call: {str(e)}"
+            logger.error("%s", error_msg)
+            return {"action": "speak", "message": error_msg, "explanation": "发生未知错误"}
 
 
     def _execute_action(self, action_obj):
@@ -144,22 +507,53 @@ class ECNUChatAgent:
 
             print(f"[EXEC] Running command: {command}")
             try:
-                # 使用shell=True以支持管道、重定向等复杂命令
-                result = subprocess.run(
-                    command,
-                    shell=True,
-                    capture_output=True,
+                # 只有用到管道、重定向等 shell 特性时才使用 shell=True，其余命令直接 exec，省去一次 /bin/sh 的 fork
+                use_shell = _needs_shell(command)
+                if not use_shell:
+                    try:
+                        argv = shlex.split(command)
+                    except ValueError: # 引号不匹配等情况交给 shell 处理
+                        use_shell = True
+                self._warm_connection() # 命令执行期间预热下一次模型调用要用的连接
+                # 在新的会话中启动，超时时可以通过 killpg 结束整个进程组，避免遗留子进程；
+                # sudo 除外：setsid 会脱离控制终端，sudo 将无法提示输入密码，也用不上按终端缓存的凭据
+                new_session = command.split(None, 1)[:1] != ["sudo"]
+                proc = subprocess.Popen(
+                    command if use_shell else argv,
+                    shell=use_shell,
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.PIPE,
                     text=True,
-                    timeout=30 # 设置超时时间，防止长时间挂起
+                    env=os.environ,
+                    start_new_session=new_session,
                 )
-                stdout = result.stdout
-                stderr = result.stderr
-                return_code = result.returncode
+                try:
+                    stdout, stderr = proc.communicate(timeout=30) # 设置超时时间，防止长时间挂起
+                except subprocess.TimeoutExpired:
+                    if new_session:
+                        try:
+                            os.killpg(proc.pid, signal.SIGKILL)
+                        except ProcessLookupError: # 进程组已退出
+                            pass
+                        proc.communicate()
+                    else:
+                        # 与 agent 同属一个进程组，只能结束直接子进程；其子进程可能仍持有管道，
+                        # 不能再 communicate()（会一直等到它自行退出），只等待直接子进程并关闭管道
+                        proc.kill()
+                        proc.wait()
+                        proc.stdout.close()
+                        proc.stderr.close()
+                    raise
+                return_code = proc.returncode
+
+                if _FS_LAYOUT_CMD_RE.search(command): # 命令可能移动/删除/链接了文件，缓存的解析结果不再可信
+                    self._resolve.cache_clear()
 
                 status = "SUCCESS" if return_code == 0 else "FAILED"
                 output_summary = f"Command '{command}' finished with return code {return_code}.\nStatus: {status}\nSTDOUT:\n{stdout}\nSTDERR:\n{stderr}"
                 print(output_summary)
-                return {"result": output_summary}
+                # 写入历史的版本对过长的输出做首尾截断，避免之后每轮请求都重复发送
+                return {"result": f"Command '{command}' finished with return code {return_code}.\nStatus: {status}\nSTDOUT:\n{self._elide_output(stdout)}\nSTDERR:\n{self._elide_output(stderr)}"}
 
             except subprocess.TimeoutExpired:
                 timeout_error = f"Command '{command}' timed out after 30 seconds."
@@ -176,7 +570,7 @@ class ECNUChatAgent:
             if not file_path_str:
                 return {"result": "No file path provided in action object."}
 
-            file_path = Path(file_path_str).resolve() # 解析为绝对路径
+            file_path = self._resolve(file_path_str) # 解析为绝对路径
             print(f"[READ] Reading file: {file_path}")
 
             try:
@@ -184,20 +578,16 @@ class ECNUChatAgent:
                 if not file_path.is_file():
                      return {"result": f"File does not exist or is not a regular file: {file_path}"}
 
-                # 尝试以UTF-8读取
-                try:
-                    content = file_path.read_text(encoding='utf-8')
-                except UnicodeDecodeError:
-                    # 如果UTF-8失败，尝试latin-1作为备选
-                    try:
-                        content = file_path.read_text(encoding='latin-1')
-                        print(f"[WARN] File {file_path} was read with 'latin-1' encoding due to UTF-8 decode error.")
-                    except Exception:
-                         return {"result": f"Could not read file {file_path} with common encodings."}
+                # 直接读取字节并按 UTF-8 解码（无法解码的字节替换掉），最多只读取 _MAX_READ_BYTES + 1 字节
+                st = file_path.stat()
+                with open(file_path, 'rb') as f:
+                    data = f.read(_MAX_READ_BYTES + 1)
+                content = _decode_file_content(data, st.st_size)
 
                 success_msg = f"Successfully read file '{file_path}'. Content:\n{content}"
                 print(success_msg)
-                return {"result": success_msg}
+                # 与 read_files、命令输出一致，写入历史的内容做首尾截断，完整内容可通过 show_output 查看
+                return {"result": f"Successfully read file '{file_path}'. Content:\n{self._elide_output(content)}"}
 
             except PermissionError:
                  return {"result": f"Permission denied when reading file: {file_path}"}
@@ -205,13 +595,32 @@ class ECNUChatAgent:
                  return {"result": f"An error occurred while reading file '{file_path}': {str(e)}"}
 
 
+        elif action_type == "read_files":
+            paths = action_obj.get("paths")
+            if not paths or not isinstance(paths, list):
+                return {"result": "No file paths provided in action object."}
+
+            paths = list(dict.fromkeys(str(p) for p in paths)) # 去重并保持顺序
+            skipped = paths[_MAX_BATCH_FILES:]
+            paths = paths[:_MAX_BATCH_FILES]
+            print(f"[READ] Reading {len(paths)} files: {', '.join(paths)}")
+            results = asyncio.run(self._read_many(paths))
+            for path, content in results.items():
+                print(f"[READ] {path}:\n{content}")
+            # 每个文件的内容同样做首尾截断，完整内容可通过 show_output 查看
+            parts = [f"=== {path} ===\n{self._elide_output(content)}" for path, content in results.items()]
+            if skipped:
+                parts.append(f"Skipped {len(skipped)} files beyond the limit of {_MAX_BATCH_FILES} per read_files action: {', '.join(skipped)}")
+            return {"result": f"Read {len(paths)} files:\n" + "\n".join(parts)}
+
+
         elif action_type == "write_file":
             file_path_str = action_obj.get("path")
             content = action_obj.get("content")
             if not file_path_str or content is None: # content can be an empty string
                 return {"result": "No file path or content provided in action object."}
 
-            file_path = Path(file_path_str).resolve()
+            file_path = self._resolve(file_path_str)
             print(f"[WRITE] Writing to file: {file_path}")
             print(f"[WRITE] Content:\n{content}")
 
@@ -232,6 +641,22 @@ class ECNUChatAgent:
                  return {"result": f"An error occurred while writing file '{file_path}': {str(e)}"}
 
 
+        elif action_type == "show_output":
+            output_id = action_obj.get("id")
+            full_output = self._output_store.get(output_id)
+            if full_output is None:
+                return {"result": f"No stored output with id: {output_id}"}
+            self._output_store.move_to_end(output_id)
+
+            try:
+                offset = max(int(action_obj.get("offset", 0)), 0)
+                length = min(max(int(action_obj.get("length", _OUTPUT_ELIDE_THRESHOLD)), 1), _OUTPUT_ELIDE_THRESHOLD)
+            except (TypeError, ValueError):
+                return {"result": "offset and length must be integers."}
+            print(f"[SHOW] Showing output {output_id} [{offset}:{offset + length}]")
+            return {"result": f"Output {output_id} [{offset}:{offset + length}] of {len(full_output)} chars:\n{full_output[offset:offset + length]}"}
+
+
         elif action_type == "speak":
              message = action_obj.get("message", "")
              print(f"\n[AGENT] {message}")
@@ -240,15 +665,27 @@ class ECNUChatAgent:
 
         else:
              unknown_action = f"Unknown action type received: {action_type}"
-             print(f"[ERROR] {unknown_action}")
+             logger.error("%s", unknown_action)
              return {"result": unknown_action}
 
 
+    def close(self):
+        """释放后台线程和底层的 HTTP 连接池"""
+        self._pool.shutdown(wait=False, cancel_futures=True)
+        self.session.close()
+
     def run(self):
         """主运行循环"""
         print("\n--- Linux Command Line AI Agent Started ---")
         print("Type your commands or 'exit' to quit.\n")
 
+        try:
+            self._run_loop()
+        finally:
+            self.close()
+
+    def _run_loop(self):
+        """读取用户输入并驱动模型执行的交互循环"""
         while True:
             try:
                 user_input = input("User> ").strip()
@@ -259,7 +696,7 @@ class ECNUChatAgent:
                     break
 
                 # 将用户输入添加到历史
-                self.session_history.append({"role": "user", "content": user_input})
+                self._append_history({"role": "user", "content": user_input})
 
                 # 循环执行模型的行动计划，直到它决定Speak
                 max_steps_per_input = 10 # 防止无限循环的保险措施
@@ -271,19 +708,22 @@ class ECNUChatAgent:
                     print(f"\n[STEP {step_count}]")
 
                     # 调用模型获取下一步行动
-                    action_to_take = self._call_model(user_input if step_count == 1 else "") # 第一步传用户输入，后续不重复传
+                    # 用户输入和上一步的 Action result 都已在历史末尾，无需再额外发送 user 消息
+                    action_to_take = self._call_model()
 
                     # 关键修复点: 确保 action_to_take 是一个有效的字典
                     if not isinstance(action_to_take, dict):
-                        print(f"[ERROR] Received invalid action object: {action_to_take}")
+                        logger.error("Received invalid action object: %s", action_to_take)
                         break
 
                     # 执行行动并获取结果
                     execution_result = self._execute_action(action_to_take)
 
                     # 将行动和结果添加到历史，供下次调用模型时参考
-                    self.session_history.append({"role": "assistant", "content": json.dumps(action_to_take)})
-                    self.session_history.append({"role": "user", "content": f"Action result:\n{execution_result['result']}"})
+                    # 只序列化一次，去掉多余空白并保留中文原文；之后的预算计算直接使用缓存的 _tokens
+                    serialized = _dumps(action_to_take).decode("utf-8")
+                    self._append_history({"role": "assistant", "content": serialized})
+                    self._append_history({"role": "user", "content": f"Action result:\n{execution_result['result']}"})
 
                     # 检查是否是Speak动作，如果是，则结束本轮交互
                     if action_to_take.get("action") == "speak":
@@ -292,9 +732,6 @@ class ECNUChatAgent:
                         # self.session_history.pop() # 如果需要，可以移除最后的result消息
                         break
 
-                    # 简单限制历史长度
-                    self._truncate_history()
-
                 if final_response:
                     print(f"\n[FINAL AGENT RESPONSE] {final_response}")
 